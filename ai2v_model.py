@@ -6,6 +6,8 @@ import torch.nn as nn
 
 from torch import FloatTensor as FT
 
+from sampling import build_alias, alias_draw
+
 
 class AttentiveItemToVec(nn.Module):
     def __init__(self, padding_idx, vocab_size, embedding_size, d_alpha=60, N=1):
@@ -15,18 +17,12 @@ class AttentiveItemToVec(nn.Module):
         self.embedding_size = embedding_size
         self.d_alpha = d_alpha
         self.pad_idx = padding_idx
-        self.tvectors = nn.Embedding(self.vocab_size, self.embedding_size, padding_idx=padding_idx)
-        self.cvectors = nn.Embedding(self.vocab_size, self.embedding_size, padding_idx=padding_idx)
-        self.tvectors.weight = nn.Parameter(t.cat([FT(self.vocab_size - 1,
-                                                      self.embedding_size).uniform_(-0.5 / self.embedding_size,
-                                                                                    0.5 / self.embedding_size),
-                                                   t.zeros(1, self.embedding_size)]))
-        self.cvectors.weight = nn.Parameter(t.cat([FT(self.vocab_size - 1,
-                                                      self.embedding_size).uniform_(-0.5 / self.embedding_size,
-                                                                                    0.5 / self.embedding_size),
-                                                   t.zeros(1, self.embedding_size)]))
-        self.tvectors.weight.requires_grad = True
-        self.cvectors.weight.requires_grad = True
+        self.tvectors = nn.Embedding(self.vocab_size, self.embedding_size, padding_idx=padding_idx, sparse=True)
+        self.cvectors = nn.Embedding(self.vocab_size, self.embedding_size, padding_idx=padding_idx, sparse=True)
+        with t.no_grad():
+            for vectors in (self.tvectors, self.cvectors):
+                vectors.weight.uniform_(-0.5 / self.embedding_size, 0.5 / self.embedding_size)
+                vectors.weight[padding_idx].zero_()
         self.Ac = nn.Linear(self.embedding_size, self.d_alpha)
         self.At = nn.Linear(self.embedding_size, self.d_alpha)
         self.cos = nn.CosineSimilarity(dim=-1, eps=1e-6)
@@ -48,8 +44,7 @@ class AttentiveItemToVec(nn.Module):
 
         cosine_sim = self.cos(t_vecs, c_vecs)
         if not inference:
-            cosine_sim[t.cat([mask_pad_ids] * batch_titems.shape[1], 1).view(
-                batch_titems.shape[0], batch_titems.shape[1], -1)] = -np.inf
+            cosine_sim = cosine_sim.masked_fill(mask_pad_ids.unsqueeze(1), -np.inf)
 
         attention_weights = self.softmax(cosine_sim)
 
@@ -61,11 +56,11 @@ class AttentiveItemToVec(nn.Module):
         return z_j_1
 
     def forward_t(self, data):
-        v = data.long()
+        v = data.to(self.tvectors.weight.device, non_blocking=True)
         return self.tvectors(v)
 
     def forward_c(self, data):
-        v = data.long()
+        v = data.to(self.cvectors.weight.device, non_blocking=True)
         return self.cvectors(v)
 
 
@@ -76,11 +71,10 @@ class SGNS(nn.Module):
         self.ai2v = ai2v
         self.vocab_size = vocab_size
         self.n_negs = n_negs
-        self.weights = None
+        self.register_buffer('alias_prob', None)
+        self.register_buffer('alias_idx', None)
         if weights is not None:
-            wf = np.power(weights, 0.75)
-            wf = wf / wf.sum()
-            self.weights = FT(wf)
+            self.alias_prob, self.alias_idx = build_alias(np.power(weights, 0.75))
 
     def similarity(self, batch_sub_users, batch_tvecs, batch_titem_ids):
         return self.ai2v.W1(self.ai2v.relu(self.ai2v.W0(t.cat([batch_sub_users, batch_tvecs,
@@ -90,32 +84,28 @@ class SGNS(nn.Module):
 
     def inference(self, user_items):
         num_items = self.ai2v.tvectors.weight.size()[0]
-        citems = t.tensor([user_items])
-        all_titems = t.tensor(range(num_items)).unsqueeze(0)
-        if next(self.parameters()).is_cuda:
-            citems = citems.cuda()
-            all_titems = all_titems.cuda()
+        device = self.ai2v.tvectors.weight.device
+        citems = t.tensor([user_items], device=device)
+        all_titems = t.arange(num_items, device=device).unsqueeze(0)
         sub_users = self.ai2v(all_titems, citems, mask_pad_ids=None, inference=True)
         all_tvecs = self.ai2v.Bt(self.ai2v.forward_t(all_titems))
         sim = self.similarity(sub_users, all_tvecs, all_titems)
         return sim.squeeze(-1).squeeze(0).detach().cpu().numpy()
 
     def forward(self, batch_titems, batch_citems, mask_pad_ids):
-        if self.weights is not None:
-            batch_nitems = t.multinomial(self.weights, batch_titems.size()[0] * self.n_negs, replacement=True).view(batch_titems.size()[0], -1)
+        if self.alias_prob is not None:
+            batch_nitems = alias_draw(self.alias_prob, self.alias_idx, (batch_titems.size()[0], self.n_negs))
         else:
-            batch_nitems = FT(batch_titems.size()[0], self.n_negs).uniform_(0, self.vocab_size - 1).long()
-        if next(self.parameters()).is_cuda:
-            batch_nitems = batch_nitems.cuda()
+            # 'pad' is the last vocab index; keep it out of the candidate softmax
+            batch_nitems = t.randint(0, self.vocab_size - 1, (batch_titems.size()[0], self.n_negs),
+                                     device=self.ai2v.tvectors.weight.device)
 
         batch_titems = t.cat([batch_titems.reshape(-1, 1), batch_nitems], 1)
         batch_sub_users = self.ai2v(batch_titems, batch_citems, mask_pad_ids)
         batch_tvecs = self.ai2v.Bt(self.ai2v.forward_t(batch_titems))
-        if [param for param in self.ai2v.parameters()][0].is_cuda:
-            self.ai2v.b_l_j.cuda()
 
         sim = self.similarity(batch_sub_users, batch_tvecs, batch_titems)
 
-        soft = sim.softmax(dim=1) + 1e-6
+        soft = sim.float().softmax(dim=1) + 1e-6
         return -soft[:, 0].log().sum()
 
@@ -34,12 +34,16 @@ def parse_args():
     parser.add_argument('--trials', type=int, default=10, help="number of trials ")
     parser.add_argument('--k', type=int, default=20, help="k to use when calculating hr_k and mrr_k")
     parser.add_argument('--cuda', action='store_true', help="use CUDA")
+    parser.add_argument('--amp', action='store_true', help="run forward passes under bfloat16 autocast")
+    parser.add_argument('--compile', action='store_true', help="fuse the i2v SGNS loss with torch.compile (torch >= 2.0)")
     parser.add_argument('--window_size', type=int, default=60, help="window size")
     parser.add_argument('--log_dir', type=str, default='my_logdir', help="directory for tensorboard logs")
     parser.add_argument('--hr_out', type=str, default='./output/hr_out.csv', help="out file name of hr for test set")
     parser.add_argument('--rr_out', type=str, default='./output/rr_out.csv', help="out file name of rr for test set")
     parser.add_argument('--cnfg_out', type=str, default='./output/best_cnfg.pkl', help="best configuration file name")
     parser.add_argument('--ds_name', type=str, default='movie_lens', help="dataset name to index the model out file")
+    parser.add_argument('--num_workers', type=int, default=16, help="number of DataLoader worker processes")
+    parser.add_argument('--prefetch_factor', type=int, default=2, help="batches prefetched by each DataLoader worker")
 
     return parser.parse_args()
 
@@ -71,6 +75,8 @@ def main():
                 {"name": "patience", "type": "fixed", "value_type": "int", "value": args.patience},
                 {"name": "unk", "type": "fixed", "value_type": "str", "value": args.unk},
                 {"name": "cuda", "type": "fixed", "value": args.cuda},
+                {"name": "amp", "type": "fixed", "value": args.amp},
+                {"name": "compile", "type": "fixed", "value": args.compile},
                 {"name": "data_dir", "type": "fixed", "value_type": "str", "value": args.data_dir},
                 {"name": "save_dir", "type": "fixed", "value_type": "str", "value": args.save_dir},
                 {"name": "train", "type": "fixed", "value_type": "str", "value": args.train},
@@ -87,6 +93,8 @@ def main():
                 {"name": "hr_out", "type": "fixed", "value_type": "str", "value": args.hr_out},
                 {"name": "rr_out", "type": "fixed", "value_type": "str", "value": args.rr_out},
                 {"name": "ds_name", "type": "fixed", "value_type": "str", "value": args.ds_name},
+                {"name": "num_workers", "type": "fixed", "value_type": "int", "value": args.num_workers},
+                {"name": "prefetch_factor", "type": "fixed", "value_type": "int", "value": args.prefetch_factor},
             ],
             evaluation_function=train_evaluate_i2v,
             minimize=True,
@@ -111,6 +119,7 @@ def main():
                 {"name": "patience", "type": "fixed", "value_type": "int", "value": args.patience},
                 {"name": "unk", "type": "fixed", "value_type": "str", "value": args.unk},
                 {"name": "cuda", "type": "fixed", "value": args.cuda},
+                {"name": "amp", "type": "fixed", "value": args.amp},
                 {"name": "data_dir", "type": "fixed", "value_type": "str", "value": args.data_dir},
                 {"name": "save_dir", "type": "fixed", "value_type": "str", "value": args.save_dir},
                 {"name": "train", "type": "fixed", "value_type": "str", "value": args.train},
@@ -127,6 +136,8 @@ def main():
                 {"name": "hr_out", "type": "fixed", "value_type": "str", "value": args.hr_out},
                 {"name": "rr_out", "type": "fixed", "value_type": "str", "value": args.rr_out},
                 {"name": "ds_name", "type": "fixed", "value_type": "str", "value": args.ds_name},
+                {"name": "num_workers", "type": "fixed", "value_type": "int", "value": args.num_workers},
+                {"name": "prefetch_factor", "type": "fixed", "value_type": "int", "value": args.prefetch_factor},
             ],
             evaluation_function=train_evaluate_ai2v,
             minimize=True,
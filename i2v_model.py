@@ -3,10 +3,33 @@
 import numpy as np
 import torch as t
 import torch.nn as nn
+import torch.nn.functional as F
 
-from torch import FloatTensor as FT
 from sklearn.metrics.pairwise import cosine_similarity
 
+from sampling import build_alias, alias_draw
+
+
+def _loss(tvectors, cvectors, nvectors):
+    # negatives are passed un-negated; the sign is folded into logsigmoid so nothing is materialized.
+    # scores are promoted to fp32 so reductions stay accurate under bfloat16 autocast
+    oloss = F.logsigmoid(t.einsum('bce,be->bc', cvectors, tvectors).float()).sum(1)
+    nloss = F.logsigmoid(-t.bmm(cvectors, nvectors.transpose(1, 2)).float()).sum(2).sum(1)
+    return -(oloss + nloss).mean()
+
+
+_compiled_loss = None
+
+
+def compiled_loss():
+    # torch.compile (torch >= 2.0) fuses the elementwise + reduction chain of _loss into a single kernel.
+    # with static batch shapes, reduce-overhead also replays this loss region (not the embedding lookups
+    # or the optimizer step) as a CUDA graph. built on first use only, so importing never touches Inductor
+    global _compiled_loss
+    if _compiled_loss is None:
+        _compiled_loss = t.compile(_loss, mode='reduce-overhead', fullgraph=True)
+    return _compiled_loss
+
 
 class Bundler(nn.Module):
 
@@ -27,55 +50,55 @@ class Item2Vec(Bundler):
         self.name = 'i2v'
         self.vocab_size = vocab_size
         self.embedding_size = embedding_size
-        self.tvectors = nn.Embedding(self.vocab_size, self.embedding_size, padding_idx=padding_idx)
-        self.cvectors = nn.Embedding(self.vocab_size, self.embedding_size, padding_idx=padding_idx)
-        self.tvectors.weight = nn.Parameter(t.cat([FT(self.vocab_size - 1, self.embedding_size).uniform_(-0.5 / self.embedding_size, 0.5 / self.embedding_size), t.zeros(1, self.embedding_size)]))
-        self.cvectors.weight = nn.Parameter(t.cat([FT(self.vocab_size - 1, self.embedding_size).uniform_(-0.5 / self.embedding_size, 0.5 / self.embedding_size), t.zeros(1, self.embedding_size)]))
-        self.tvectors.weight.requires_grad = True
-        self.cvectors.weight.requires_grad = True
+        self.tvectors = nn.Embedding(self.vocab_size, self.embedding_size, padding_idx=padding_idx, sparse=True)
+        self.cvectors = nn.Embedding(self.vocab_size, self.embedding_size, padding_idx=padding_idx, sparse=True)
+        with t.no_grad():
+            for vectors in (self.tvectors, self.cvectors):
+                vectors.weight.uniform_(-0.5 / self.embedding_size, 0.5 / self.embedding_size)
+                vectors.weight[padding_idx].zero_()
 
     def forward(self, data):
         return self.forward_i(data)
 
     def forward_t(self, data):
-        v = data.long()
+        v = data.to(self.tvectors.weight.device, non_blocking=True)
         return self.tvectors(v)
 
     def forward_c(self, data):
-        v = data.long()
+        v = data.to(self.cvectors.weight.device, non_blocking=True)
         return self.cvectors(v)
 
 
 class SGNS(nn.Module):
 
-    def __init__(self, embedding, vocab_size=20000, n_negs=20, weights=None):
+    def __init__(self, embedding, vocab_size=20000, n_negs=20, weights=None, compile_loss=False):
         super(SGNS, self).__init__()
         self.embedding = embedding
         self.vocab_size = vocab_size
         self.n_negs = n_negs
-        self.weights = None
+        self.compile_loss = compile_loss
+        self.register_buffer('alias_prob', None)
+        self.register_buffer('alias_idx', None)
         if weights is not None:
-            wf = np.power(weights, 0.75)
-            wf = wf / wf.sum()
-            self.weights = FT(wf)
+            self.alias_prob, self.alias_idx = build_alias(np.power(weights, 0.75))
 
     def forward(self, titems, citems):
         batch_size = titems.size()[0]
         context_size = citems.size()[1]
-        if self.weights is not None:
-            nitems = t.multinomial(self.weights, batch_size * context_size * self.n_negs, replacement=True).view(batch_size, -1)
+        if self.alias_prob is not None:
+            nitems = alias_draw(self.alias_prob, self.alias_idx, (batch_size, context_size * self.n_negs))
         else:
-            nitems = FT(batch_size, self.n_negs).uniform_(0, self.vocab_size - 1).long()
-        if next(self.parameters()).is_cuda:
-            nitems = nitems.cuda()
-        tvectors = self.embedding.forward_t(titems)
+            # preprocess puts 'pad' last in the vocab, so [0, V-1) never draws it as a negative
+            nitems = t.randint(0, self.vocab_size - 1, (batch_size, context_size * self.n_negs),
+                               device=self.embedding.tvectors.weight.device)
+        # targets and negatives live in the same table, so gather them together and split afterwards
+        all_titems = t.cat([titems.view(-1, 1), nitems], dim=1)
+        all_tvectors = self.embedding.forward_t(all_titems)
+        tvectors, nvectors = all_tvectors[:, 0], all_tvectors[:, 1:]
         cvectors = self.embedding.forward_c(citems)
-        nvectors = self.embedding.forward_t(nitems).neg()
-
-        all_tvectors = t.cat([tvectors.unsqueeze(1), nvectors], dim=1)
-        loss = t.bmm(cvectors, all_tvectors.transpose(1, 2))
 
-        return -loss.sigmoid().log().sum(2).sum(1).mean()
+        loss_fn = compiled_loss() if self.compile_loss else _loss
+        return loss_fn(tvectors, cvectors, nvectors)
 
     def represent_user(self, user_itemids):
         context_vecs = self.embedding.cvectors.weight.data.cpu().numpy()
@@ -0,0 +1,29 @@
+import numpy as np
+import torch as t
+
+
+def build_alias(probs):
+    # Walker's alias method: O(V) setup once, then O(1) per drawn sample
+    probs = np.asarray(probs, dtype=np.float64)
+    n = len(probs)
+    scaled = probs * n / probs.sum()
+    prob = np.ones(n)
+    alias = np.arange(n)
+    small = [i for i in range(n) if scaled[i] < 1.0]
+    large = [i for i in range(n) if scaled[i] >= 1.0]
+    while small and large:
+        sm, lg = small.pop(), large.pop()
+        prob[sm] = scaled[sm]
+        alias[sm] = lg
+        scaled[lg] = scaled[lg] + scaled[sm] - 1.0
+        if scaled[lg] < 1.0:
+            small.append(lg)
+        else:
+            large.append(lg)
+    return t.tensor(prob, dtype=t.float32), t.tensor(alias, dtype=t.long)
+
+
+def alias_draw(prob, alias, size):
+    k = t.randint(0, prob.size(0), size, device=prob.device)
+    r = t.rand(size, device=prob.device)
+    return t.where(r < prob[k], k, alias[k])
@@ -4,17 +4,15 @@ import datetime
 import pathlib
 import pickle
 
-import numpy as np
 import torch as t
 from torch.optim import Adagrad, lr_scheduler, AdamW, Adam
-from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
 from ai2v_model import AttentiveItemToVec
 from ai2v_model import SGNS
 
-from train_utils import save_model, configure_weights, UserBatchIncrementDataset
+from train_utils import save_model, configure_weights, build_dataloader, load_pickle, UserBatchIncrementDataset
 from evaluation import hr_k, mrr_k
 
 import argparse
@@ -28,6 +26,7 @@ def parse_args():
     parser.add_argument('--test', type=str, default='test_batch_u.dat', help="test users file name")
     parser.add_argument('--unk', type=str, default='<UNK>', help="UNK token")
     parser.add_argument('--cuda', action='store_true', help="use CUDA")
+    parser.add_argument('--amp', action='store_true', help="run forward passes under bfloat16 autocast")
     parser.add_argument('--max_batch_size', type=int, default=200, help="max number of training obs in batch")
     parser.add_argument('--log_dir', type=str, default='tensorboard/logs/mylogdir', help="logs dir for tensorboard")
     parser.add_argument('--k', type=int, default=20, help="k to calc hrr_k and mrr_k evaluation metrics")
@@ -35,55 +34,65 @@ def parse_args():
     parser.add_argument('--rr_out', type=str, default='./output/mrr_out.csv', help="hit at K for each test row")
     parser.add_argument('--best_cnfg', type=str, default='./output/best_cnfg.csv', help="best cnfg of hyper params")
     parser.add_argument('--max_epochs', type=int, default=50, help='number of early stop epochs to train the model over')
+    parser.add_argument('--num_workers', type=int, default=16, help="number of DataLoader worker processes")
+    parser.add_argument('--prefetch_factor', type=int, default=2, help="batches prefetched by each DataLoader worker")
     parser.add_argument('--ds_name', type=str, default='movie_lens', help="dataset name to index the model out file")
 
     return parser.parse_args()
 
 
-def run_epoch(train_dl, epoch, sgns, optim, pad_idx):
+def run_epoch(train_dl, epoch, sgns, optim, pad_idx, amp=False):
+    device = next(sgns.parameters()).device
     pbar = tqdm(train_dl)
     pbar.set_description("[Epoch {}]".format(epoch))
-    train_loss = 0
+    loss_sum = t.zeros((), device=device)
+    count = 0
 
     srt = datetime.datetime.now().replace(microsecond=0)
-    for batch_titems, batch_citems in pbar:
-        if next(sgns.parameters()).is_cuda:
-            batch_titems, batch_citems = batch_titems.cuda(), batch_citems.cuda()
+    for i, (batch_titems, batch_citems) in enumerate(pbar):
+        batch_titems = batch_titems.to(device, non_blocking=True)
+        batch_citems = batch_citems.to(device, non_blocking=True)
         mask_pad_ids = (batch_citems == pad_idx)
-        loss = sgns(batch_titems, batch_citems, mask_pad_ids)
-        train_loss += loss.item()
+        with t.autocast(device.type, dtype=t.bfloat16, enabled=amp):
+            loss = sgns(batch_titems, batch_citems, mask_pad_ids)
+        loss_sum += loss.detach()
+        count += 1
         optim.zero_grad()
         loss.backward()
         optim.step()
-        pbar.set_postfix(train_loss=loss.item())
+        if i % 50 == 0:
+            pbar.set_postfix(train_loss=(loss_sum / count).item())
 
-    train_loss = train_loss / len(pbar)
+    if count == 0:
+        raise ValueError(f'epoch {epoch} produced no training batches; check the train set size and mini_batch')
+    train_loss = (loss_sum / count).item()
     print(f'train_loss: {train_loss}')
     end = datetime.datetime.now().replace(microsecond=0)
     print('epoch time: ', end-srt)
     return train_loss, sgns
 
 
-def calc_loss_on_set(sgns, valid_users_path, pad_idx, batch_size, window_size):
-    dataset = UserBatchIncrementDataset(valid_users_path, pad_idx, window_size)
-    valid_dl = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=16, pin_memory=True)
-
+def calc_loss_on_set(sgns, valid_dl, pad_idx, amp=False):
+    device = next(sgns.parameters()).device
     pbar = tqdm(valid_dl)
-    valid_losses = []
+    loss_sum = t.zeros((), device=device)
+    count = 0
 
     for batch_titems, batch_citems in pbar:
-        if next(sgns.parameters()).is_cuda:
-            batch_titems, batch_citems = batch_titems.cuda(), batch_citems.cuda()
+        batch_titems = batch_titems.to(device, non_blocking=True)
+        batch_citems = batch_citems.to(device, non_blocking=True)
 
         mask_pad_ids = (batch_citems == pad_idx)
-        loss = sgns(batch_titems, batch_citems, mask_pad_ids)
-        valid_losses.append(loss.item())
+        with t.no_grad(), t.autocast(device.type, dtype=t.bfloat16, enabled=amp):
+            loss = sgns(batch_titems, batch_citems, mask_pad_ids)
+        loss_sum += loss
+        count += 1
 
-    return np.array(valid_losses).mean()
+    return (loss_sum / count).item()
 
 
-def train_early_stop(cnfg, valid_users_path, pad_idx):
-    idx2item = pickle.load(pathlib.Path(cnfg['data_dir'], cnfg['idx2item']).open('rb'))
+def train_early_stop(cnfg, valid_dl, pad_idx):
+    idx2item = load_pickle(pathlib.Path(cnfg['data_dir'], cnfg['idx2item']))
 
     weights = configure_weights(cnfg, idx2item)
     vocab_size = len(idx2item)
@@ -101,24 +110,29 @@ def train_early_stop(cnfg, valid_users_path, pad_idx):
     writer = SummaryWriter(log_dir=log_dir)
 
     best_epoch = cnfg['max_epoch'] + 1
-    valid_losses = [np.inf]
+    valid_losses = [float('inf')]
     patience_count = 0
-    t.autograd.set_detect_anomaly(True)
+    best_state = None
+    if cnfg.get('anomaly_detect', False):
+        t.autograd.set_detect_anomaly(True)
 
     dataset = UserBatchIncrementDataset(pathlib.Path(cnfg['data_dir'], cnfg['train']), pad_idx, cnfg['window_size'])
-    train_loader = DataLoader(dataset, batch_size=cnfg['mini_batch'], shuffle=True, num_workers=16, pin_memory=True)
+    train_loader = build_dataloader(dataset, cnfg['mini_batch'], shuffle=True,
+                                    num_workers=cnfg.get('num_workers', 16),
+                                    prefetch_factor=cnfg.get('prefetch_factor', 2))
 
     for epoch in range(1, cnfg['max_epoch'] + 1):
-        train_loss, sgns = run_epoch(train_loader, epoch, sgns, optim, pad_idx)
+        train_loss, sgns = run_epoch(train_loader, epoch, sgns, optim, pad_idx, cnfg.get('amp', False))
         writer.add_scalar("Loss/train", train_loss, epoch)
 
-        valid_loss = calc_loss_on_set(sgns, valid_users_path, pad_idx, cnfg['mini_batch'], cnfg['window_size'])
+        valid_loss = calc_loss_on_set(sgns, valid_dl, pad_idx, cnfg.get('amp', False))
         writer.add_scalar("Loss/validation", valid_loss, epoch)
         print(f'valid loss:{valid_loss}')
 
         if valid_loss < valid_losses[-1]:
             patience_count = 0
             best_epoch = epoch
+            best_state = {k: v.detach().clone() for k, v in sgns.state_dict().items()}
             save_model(cnfg, model, sgns)
 
         else:
@@ -133,7 +147,7 @@ def train_early_stop(cnfg, valid_users_path, pad_idx):
     writer.flush()
     writer.close()
 
-    return best_epoch
+    return best_epoch, sgns, best_state
 
 
 def train(cnfg):
@@ -142,8 +156,8 @@ def train(cnfg):
     # cnfg['n_negs'] = 7
     # cnfg['mini_batch'] = 32
     print(cnfg)
-    idx2item = pickle.load(pathlib.Path(cnfg['data_dir'], cnfg['idx2item']).open('rb'))
-    item2idx = pickle.load(pathlib.Path(cnfg['data_dir'], cnfg['item2idx']).open('rb'))
+    idx2item = load_pickle(pathlib.Path(cnfg['data_dir'], cnfg['idx2item']))
+    item2idx = load_pickle(pathlib.Path(cnfg['data_dir'], cnfg['item2idx']))
 
     weights = configure_weights(cnfg, idx2item)
     vocab_size = len(idx2item)
@@ -152,7 +166,9 @@ def train(cnfg):
     sgns = SGNS(ai2v=model, vocab_size=vocab_size, n_negs=cnfg['n_negs'], weights=weights)
     dataset = UserBatchIncrementDataset(pathlib.Path(cnfg['data_dir'], cnfg['train']), item2idx['pad'],
                                         cnfg['window_size'])
-    train_loader = DataLoader(dataset, batch_size=cnfg['mini_batch'], shuffle=True, pin_memory=True, num_workers=16)
+    train_loader = build_dataloader(dataset, cnfg['mini_batch'], shuffle=True,
+                                    num_workers=cnfg.get('num_workers', 16),
+                                    prefetch_factor=cnfg.get('prefetch_factor', 2))
 
     if cnfg['cuda']:
         sgns = sgns.cuda()
@@ -161,7 +177,7 @@ def train(cnfg):
     scheduler = lr_scheduler.MultiStepLR(optim, milestones=[2, 4, 6, 8, 10, 12, 14, 16], gamma=0.5)
 
     for epoch in range(1, cnfg['max_epoch'] + 1):
-        train_loss, sgns = run_epoch(train_loader, epoch, sgns, optim, item2idx['pad'])
+        train_loss, sgns = run_epoch(train_loader, epoch, sgns, optim, item2idx['pad'], cnfg.get('amp', False))
         scheduler.step()
 
     save_model(cnfg, model, sgns)
@@ -170,7 +186,7 @@ def train(cnfg):
     log_dir = cnfg['log_dir'] + '/' + str(datetime.datetime.now().timestamp())
     writer = SummaryWriter(log_dir=log_dir)
 
-    eval_set = pickle.load(pathlib.Path(cnfg['data_dir'], cnfg['test']).open('rb'))
+    eval_set = load_pickle(pathlib.Path(cnfg['data_dir'], cnfg['test']))
     k = cnfg['k']
 
     writer.add_hparams(hparam_dict=cnfg,
@@ -189,13 +205,20 @@ def train_evaluate(cnfg):
     # cnfg['mini_batch'] = 32
     print(cnfg)
     valid_users_path = pathlib.Path(cnfg['data_dir'], cnfg['valid'])
-    item2idx = pickle.load(pathlib.Path(cnfg['data_dir'], cnfg['item2idx']).open('rb'))
+    item2idx = load_pickle(pathlib.Path(cnfg['data_dir'], cnfg['item2idx']))
 
-    best_epoch = train_early_stop(cnfg, valid_users_path, item2idx['pad'])
+    valid_dataset = UserBatchIncrementDataset(valid_users_path, item2idx['pad'], cnfg['window_size'])
+    valid_dl = build_dataloader(valid_dataset, cnfg['mini_batch'], shuffle=False,
+                                num_workers=cnfg.get('num_workers', 16),
+                                prefetch_factor=cnfg.get('prefetch_factor', 2))
 
-    best_model = t.load(pathlib.Path(cnfg['save_dir'], cnfg['model'] + f'_{cnfg["ds_name"]}.pt'))
+    best_epoch, sgns, best_state = train_early_stop(cnfg, valid_dl, item2idx['pad'])
+    if best_state is not None:
+        sgns.load_state_dict(best_state)
+    else:
+        print('no validation improvement was recorded, evaluating the last trained weights')
 
-    valid_loss = calc_loss_on_set(best_model, valid_users_path, item2idx['pad'], cnfg['mini_batch'], cnfg['window_size'])
+    valid_loss = calc_loss_on_set(sgns, valid_dl, item2idx['pad'], cnfg.get('amp', False))
     return {'valid_loss': (valid_loss, 0.0), 'early_stop_epoch': (best_epoch, 0.0)}
 
 
@@ -4,16 +4,14 @@ import datetime
 import pathlib
 import pickle
 
-import numpy as np
 import torch as t
 from torch.optim import Adagrad
-from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
 from i2v_model import Item2Vec
 from i2v_model import SGNS
-from train_utils import save_model, configure_weights, UserBatchIncrementDataset
+from train_utils import save_model, configure_weights, build_dataloader, load_pickle, UserBatchIncrementDataset
 from evaluation import hr_k, mrr_k
 
 import argparse
@@ -27,6 +25,8 @@ def parse_args():
     parser.add_argument('--test', type=str, default='test_batch_u.dat', help="test users file name")
     parser.add_argument('--unk', type=str, default='<UNK>', help="UNK token")
     parser.add_argument('--cuda', action='store_true', help="use CUDA")
+    parser.add_argument('--amp', action='store_true', help="run forward passes under bfloat16 autocast")
+    parser.add_argument('--compile', action='store_true', help="fuse the SGNS loss with torch.compile (torch >= 2.0)")
     parser.add_argument('--max_batch_size', type=int, default=200, help="max number of training obs in batch")
     parser.add_argument('--log_dir', type=str, default='tensorboard/logs/mylogdir', help="logs dir for tensorboard")
     parser.add_argument('--k', type=int, default=20, help="k to calc hrr_k and mrr_k evaluation metrics")
@@ -34,43 +34,56 @@ def parse_args():
     parser.add_argument('--rr_out', type=str, default='./output/mrr_out.csv', help="hit at K for each test row")
     parser.add_argument('--best_cnfg', type=str, default='./output/best_cnfg.csv', help="best cnfg of hyper params")
     parser.add_argument('--max_epochs', type=int, default=50, help='number of early stop epochs to train the model over')
+    parser.add_argument('--num_workers', type=int, default=16, help="number of DataLoader worker processes")
+    parser.add_argument('--prefetch_factor', type=int, default=2, help="batches prefetched by each DataLoader worker")
 
     return parser.parse_args()
 
 
-def run_epoch(train_dl, epoch, sgns, optim):
+def run_epoch(train_dl, epoch, sgns, optim, amp=False):
+    device = next(sgns.parameters()).device
     pbar = tqdm(train_dl)
     pbar.set_description("[Epoch {}]".format(epoch))
-    train_losses = []
+    loss_sum = t.zeros((), device=device)
+    count = 0
 
-    for batch_titems, batch_citems in pbar:
-        if next(sgns.parameters()).is_cuda:
-            batch_titems, batch_citems = batch_titems.cuda(), batch_citems.cuda()
-        loss = sgns(batch_titems, batch_citems)
+    for i, (batch_titems, batch_citems) in enumerate(pbar):
+        batch_titems = batch_titems.to(device, non_blocking=True)
+        batch_citems = batch_citems.to(device, non_blocking=True)
+        with t.autocast(device.type, dtype=t.bfloat16, enabled=amp):
+            loss = sgns(batch_titems, batch_citems)
 
-        train_losses.append(loss.item())
+        loss_sum += loss.detach()
+        count += 1
         optim.zero_grad()
         loss.backward()
         optim.step()
-        pbar.set_postfix(train_loss=loss.item())
+        if i % 50 == 0:
+            pbar.set_postfix(train_loss=(loss_sum / count).item())
 
-    train_loss = np.array(train_losses).mean()
+    if count == 0:
+        raise ValueError(f'epoch {epoch} produced no training batches; check the train set size and mini_batch')
+    train_loss = (loss_sum / count).item()
     print(f'train_loss: {train_loss}')
     return train_loss, sgns
 
 
 def train(cnfg):
-    idx2item = pickle.load(pathlib.Path(cnfg['data_dir'], cnfg['idx2item']).open('rb'))
-    item2idx = pickle.load(pathlib.Path(cnfg['data_dir'], cnfg['item2idx']).open('rb'))
+    idx2item = load_pickle(pathlib.Path(cnfg['data_dir'], cnfg['idx2item']))
+    item2idx = load_pickle(pathlib.Path(cnfg['data_dir'], cnfg['item2idx']))
 
     weights = configure_weights(cnfg, idx2item)
     vocab_size = len(idx2item)
 
     model = Item2Vec(padding_idx=item2idx['pad'], vocab_size=vocab_size, embedding_size=cnfg['e_dim'])
-    sgns = SGNS(embedding=model, vocab_size=vocab_size, n_negs=cnfg['n_negs'], weights=weights)
+    sgns = SGNS(embedding=model, vocab_size=vocab_size, n_negs=cnfg['n_negs'], weights=weights,
+                compile_loss=cnfg.get('compile', False))
     dataset = UserBatchIncrementDataset(pathlib.Path(cnfg['data_dir'], cnfg['train']), item2idx['pad'],
                                         cnfg['window_size'])
-    train_loader = DataLoader(dataset, batch_size=cnfg['mini_batch'], shuffle=True, num_workers=16, pin_memory=True)
+    train_loader = build_dataloader(dataset, cnfg['mini_batch'], shuffle=True,
+                                    num_workers=cnfg.get('num_workers', 16),
+                                    prefetch_factor=cnfg.get('prefetch_factor', 2),
+                                    static_shapes=cnfg.get('compile', False))
 
     if cnfg['cuda']:
         sgns = sgns.cuda()
@@ -78,7 +91,7 @@ def train(cnfg):
     optim = Adagrad(sgns.parameters(), lr=cnfg['lr'])
 
     for epoch in range(1, cnfg['max_epoch'] + 1):
-        train_loss, sgns = run_epoch(train_loader, epoch, sgns, optim)
+        train_loss, sgns = run_epoch(train_loader, epoch, sgns, optim, cnfg.get('amp', False))
 
     save_model(cnfg, model, sgns)
 
@@ -86,7 +99,7 @@ def train(cnfg):
     log_dir = cnfg['log_dir'] + '/' + str(datetime.datetime.now().timestamp())
     writer = SummaryWriter(log_dir=log_dir)
 
-    eval_set = pickle.load(pathlib.Path(cnfg['data_dir'], cnfg['test']).open('rb'))
+    eval_set = load_pickle(pathlib.Path(cnfg['data_dir'], cnfg['test']))
     k = cnfg['k']
 
     writer.add_hparams(hparam_dict=cnfg,
@@ -98,30 +111,32 @@ def train(cnfg):
     writer.close()
 
 
-def calc_loss_on_set(sgns, valid_users_path, pad_idx, batch_size, window_size):
-    dataset = UserBatchIncrementDataset(valid_users_path, pad_idx, window_size)
-    valid_dl = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=16, pin_memory=True)
-
+def calc_loss_on_set(sgns, valid_dl, amp=False):
+    device = next(sgns.parameters()).device
     pbar = tqdm(valid_dl)
-    valid_losses = []
+    loss_sum = t.zeros((), device=device)
+    count = 0
 
     for batch_titems, batch_citems in pbar:
-        if next(sgns.parameters()).is_cuda:
-            batch_titems, batch_citems = batch_titems.cuda(), batch_citems.cuda()
-        loss = sgns(batch_titems, batch_citems)
-        valid_losses.append(loss.item())
+        batch_titems = batch_titems.to(device, non_blocking=True)
+        batch_citems = batch_citems.to(device, non_blocking=True)
+        with t.no_grad(), t.autocast(device.type, dtype=t.bfloat16, enabled=amp):
+            loss = sgns(batch_titems, batch_citems)
+        loss_sum += loss
+        count += 1
 
-    return np.array(valid_losses).mean()
+    return (loss_sum / count).item()
 
 
-def train_early_stop(cnfg, valid_users_path, pad_idx):
-    idx2item = pickle.load(pathlib.Path(cnfg['data_dir'], cnfg['idx2item']).open('rb'))
+def train_early_stop(cnfg, valid_dl, pad_idx):
+    idx2item = load_pickle(pathlib.Path(cnfg['data_dir'], cnfg['idx2item']))
 
     weights = configure_weights(cnfg, idx2item)
     vocab_size = len(idx2item)
 
     model = Item2Vec(padding_idx=pad_idx, vocab_size=vocab_size, embedding_size=cnfg['e_dim'])
-    sgns = SGNS(embedding=model, vocab_size=vocab_size, n_negs=cnfg['n_negs'], weights=weights)
+    sgns = SGNS(embedding=model, vocab_size=vocab_size, n_negs=cnfg['n_negs'], weights=weights,
+                compile_loss=cnfg.get('compile', False))
 
     if cnfg['cuda']:
         sgns = sgns.cuda()
@@ -131,24 +146,29 @@ def train_early_stop(cnfg, valid_users_path, pad_idx):
     writer = SummaryWriter(log_dir=log_dir)
 
     best_epoch = cnfg['max_epoch'] + 1
-    valid_losses = [np.inf]
+    valid_losses = [float('inf')]
     patience_count = 0
+    best_state = None
 
     dataset = UserBatchIncrementDataset(pathlib.Path(cnfg['data_dir'], cnfg['train']), pad_idx, cnfg['window_size'])
-    train_loader = DataLoader(dataset, batch_size=cnfg['mini_batch'], shuffle=True, num_workers=16, pin_memory=True)
+    train_loader = build_dataloader(dataset, cnfg['mini_batch'], shuffle=True,
+                                    num_workers=cnfg.get('num_workers', 16),
+                                    prefetch_factor=cnfg.get('prefetch_factor', 2),
+                                    static_shapes=cnfg.get('compile', False))
 
     for epoch in range(1, cnfg['max_epoch'] + 1):
-        train_loss, sgns = run_epoch(train_loader, epoch, sgns, optim)
+        train_loss, sgns = run_epoch(train_loader, epoch, sgns, optim, cnfg.get('amp', False))
         writer.add_scalar("Loss/train", train_loss, epoch)
         # log specific training example loss
 
-        valid_loss = calc_loss_on_set(sgns, valid_users_path, pad_idx, cnfg['mini_batch'], cnfg['window_size'])
+        valid_loss = calc_loss_on_set(sgns, valid_dl, cnfg.get('amp', False))
         writer.add_scalar("Loss/validation", valid_loss, epoch)
         print(f'valid loss:{valid_loss}')
 
         if valid_loss < valid_losses[-1]:
             patience_count = 0
             best_epoch = epoch
+            best_state = {k: v.detach().clone() for k, v in sgns.state_dict().items()}
             save_model(cnfg, model, sgns)
 
         else:
@@ -162,19 +182,26 @@ def train_early_stop(cnfg, valid_users_path, pad_idx):
     writer.flush()
     writer.close()
 
-    return best_epoch
+    return best_epoch, sgns, best_state
 
 
 def train_evaluate(cnfg):
     print(cnfg)
     valid_users_path = pathlib.Path(cnfg['data_dir'], cnfg['valid'])
-    item2idx = pickle.load(pathlib.Path(cnfg['data_dir'], cnfg['item2idx']).open('rb'))
+    item2idx = load_pickle(pathlib.Path(cnfg['data_dir'], cnfg['item2idx']))
 
-    best_epoch = train_early_stop(cnfg, valid_users_path, item2idx['pad'])
+    valid_dataset = UserBatchIncrementDataset(valid_users_path, item2idx['pad'], cnfg['window_size'])
+    valid_dl = build_dataloader(valid_dataset, cnfg['mini_batch'], shuffle=False,
+                                num_workers=cnfg.get('num_workers', 16),
+                                prefetch_factor=cnfg.get('prefetch_factor', 2))
 
-    best_model = t.load(pathlib.Path(cnfg['save_dir'], cnfg['model'] + f'_{cnfg["ds_name"]}.pt'))
+    best_epoch, sgns, best_state = train_early_stop(cnfg, valid_dl, item2idx['pad'])
+    if best_state is not None:
+        sgns.load_state_dict(best_state)
+    else:
+        print('no validation improvement was recorded, evaluating the last trained weights')
 
-    valid_loss = calc_loss_on_set(best_model, valid_users_path, item2idx['pad'], cnfg['mini_batch'], cnfg['window_size'])
+    valid_loss = calc_loss_on_set(sgns, valid_dl, cnfg.get('amp', False))
     return {'valid_loss': (valid_loss, 0.0), 'early_stop_epoch': (best_epoch, 0.0)}
 
 
@@ -1,39 +1,23 @@
 import pathlib
 import pickle
 import random
+from functools import lru_cache
 
 import numpy as np
 import torch as t
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset
 
 
-class UserBatchIncrementDataset(Dataset):
-    def __init__(self, datapath, pad_idx, window_size, ws=None):
-        data = pickle.load(datapath.open('rb'))
-        if ws is not None:
-            data_ws = []
-            for citems, titem in data:
-                if random.random() > ws[titem]:
-                    data_ws.append((citems, titem))
-            data = data_ws
-
-        padded_data = []
-        for sub_user in data:
-            padded_data.append((sub_user[0] + [pad_idx for _ in range(window_size - len(sub_user[0]))], sub_user[1]))
-
-        self.data = padded_data
-
-    def __len__(self):
-        return len(self.data)
-
-    def __getitem__(self, idx):
-        citems, titem = self.data[idx]
-        return titem, np.array(citems)
+@lru_cache(maxsize=8)
+def load_pickle(path):
+    # vocab, item counts and sample files are re-read by every tuning trial; parse each path once per process
+    with open(path, 'rb') as f:
+        return pickle.load(f)
 
 
 class UserBatchIncrementDataset(Dataset):
     def __init__(self, datapath, pad_idx, window_size, ws=None):
-        data = pickle.load(datapath.open('rb'))
+        data = load_pickle(datapath)
         self.pad_idx = pad_idx
         self.window_size = window_size
 
@@ -53,12 +37,12 @@ class UserBatchIncrementDataset(Dataset):
         pad_times = self.window_size - len_samp
         citems = self.data[idx][0] + [self.pad_idx] * pad_times
         titem = self.data[idx][1]
-        # citems = self.data[idx][0]
-        return titem, np.array(citems)
+        # int64 ids collate straight into LongTensors, so the lookups need no cast on the hot path
+        return titem, np.array(citems, dtype=np.int64)
 
 
 def configure_weights(cnfg, idx2item):
-    ic = pickle.load(pathlib.Path(cnfg['data_dir'], 'ic.dat').open('rb'))
+    ic = load_pickle(pathlib.Path(cnfg['data_dir'], 'ic.dat'))
 
     ifr = np.array([ic[item] for item in idx2item])
     ifr = ifr / ifr.sum()
@@ -70,6 +54,16 @@ def configure_weights(cnfg, idx2item):
     return weights
 
 
+def build_dataloader(dataset, batch_size, shuffle, num_workers=16, prefetch_factor=2, static_shapes=False):
+    # CUDA-graph replay of the compiled loss needs every batch to have the same shape, so drop the partial
+    # last batch - unless it would be the only one
+    drop_last = static_shapes and len(dataset) >= batch_size
+    if num_workers == 0:
+        return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, pin_memory=True, drop_last=drop_last)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, pin_memory=True, num_workers=num_workers,
+                      prefetch_factor=prefetch_factor, persistent_workers=True, drop_last=drop_last)
+
+
 def save_model(cnfg, model, sgns):
     tvectors = model.tvectors.weight.data.cpu().numpy()
     cvectors = model.cvectors.weight.data.cpu().numpy()